@@ -1,27 +1,80 @@
 import pandas as pd
 import numpy as np
+from pandas.api.types import is_datetime64_any_dtype, is_timedelta64_dtype
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from .models import Roster, Attendance
 import datetime
-import io
-from rapidfuzz import process, fuzz
-from django.db.models import Q
-
-def to_safe_time(t):
-    if pd.isna(t) or t is None: return None
-    if isinstance(t, datetime.time): return t
-    if isinstance(t, (float, int)):
-        total_seconds = int(t * 24 * 60 * 60)
-        total_seconds = min(total_seconds, 86399)
-        hours, remainder = divmod(total_seconds, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        return datetime.time(hours, minutes, seconds)
-    try:
-        return pd.to_datetime(str(t), errors='coerce').time()
-    except (ValueError, TypeError):
-        return None
+import operator
+from functools import reduce
+from rapidfuzz import fuzz, utils
+from rapidfuzz.process import cdist
+from django.db import connection, transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+
+def upload_source(uploaded_file):
+    # Large uploads are already spooled to disk by Django; read them from there.
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        return uploaded_file.temporary_file_path()
+    return uploaded_file
+
+def seconds_to_time(secs, index):
+    secs = np.round(secs.dropna()).clip(0, 86399).astype('int32')
+    result = pd.Series(None, index=index, dtype=object)
+    # Split into h/m/s as whole arrays; the comprehension only sees plain Python ints.
+    hours, minutes, seconds = (secs // 3600).tolist(), (secs % 3600 // 60).tolist(), (secs % 60).tolist()
+    result.loc[secs.index] = [datetime.time(h, m, s) for h, m, s in zip(hours, minutes, seconds)]
+    return result
+
+def vec_to_time(series):
+    # to_numeric would turn these into int64 nanoseconds, so handle them by dtype first.
+    if is_datetime64_any_dtype(series):
+        return series.dt.time.astype(object).where(series.notna(), None)
+    if is_timedelta64_dtype(series):
+        return seconds_to_time(series.dt.total_seconds(), series.index)
+
+    num = pd.to_numeric(series, errors='coerce')
+    result = seconds_to_time(num * 86400, series.index)
+    # Anything that isn't an Excel day fraction (time cells, "HH:MM" strings) goes through the parser.
+    rest = series[num.isna() & series.notna()]
+    if not rest.empty:
+        parsed = pd.to_datetime(rest.astype(str), errors='coerce')
+        result.loc[rest.index] = [t.time() if pd.notna(t) else None for t in parsed]
+    return result
+
+NAME_MATCH_CUTOFF = 90
+
+WFO_SCHEDULES = {'WFO-M', 'WFO-G', 'WFO-G2', 'WFO-S', 'WFO-N'}
+WFH_SCHEDULES = {'WFH-M', 'WFH-G', 'WFH-G2', 'WFH-S', 'WFH-N'}
+
+SCHEDULE_BUCKET = {s: 'wfo' for s in WFO_SCHEDULES} | {s: 'wfh' for s in WFH_SCHEDULES} | {'WO': 'wo', 'PL': 'pl'}
+
+def schedule_filter(schedules):
+    return reduce(operator.or_, (Q(schedule__iexact=s) for s in schedules))
+
+SCHEDULE_BUCKET_COUNTS = {
+    bucket: Count('id', filter=schedule_filter(s for s, b in SCHEDULE_BUCKET.items() if b == bucket))
+    for bucket in set(SCHEDULE_BUCKET.values())
+}
+
+def name_filter(query):
+    # Every word must appear somewhere in the name; repeated words add nothing to the WHERE clause.
+    return reduce(operator.and_, (Q(name__icontains=w) for w in dict.fromkeys(query.split())), Q())
+
+TIME_COLUMNS = ['first_in', 'last_out', 'gross_time', 'out_of_office_time', 'net_office_time']
+
+ATTENDANCE_UPDATE_FIELDS = [
+    'employee_id', 'user_type', 'designation', 'department', 'location', 'first_in', 'last_out',
+    'gross_time', 'out_of_office_time', 'out_of_office_count', 'net_office_time'
+]
+
+def upsert_options(unique_fields, update_fields):
+    options = {'update_conflicts': True, 'update_fields': update_fields, 'batch_size': 5000}
+    # MySQL upserts via ON DUPLICATE KEY and rejects an explicit conflict target.
+    if connection.features.supports_update_conflicts_with_target:
+        options['unique_fields'] = unique_fields
+    return options
 
 class FileUploadView(APIView):
     def post(self, request, *args, **kwargs):
@@ -34,14 +87,19 @@ class FileUploadView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
         try:
-            roster_df = pd.read_excel(io.BytesIO(roster_file.read()), header=0, skiprows=[1])
+            roster_df = pd.read_excel(upload_source(roster_file), engine='calamine', header=0, skiprows=[1])
             roster_df.columns = [str(c).strip().lower() for c in roster_df.columns]
-            attendance_df = pd.read_excel(io.BytesIO(attendance_file.read()), header=None, skiprows=1)
+            if 'sr no' not in roster_df: roster_df['sr no'] = None
+            attendance_df = pd.read_excel(upload_source(attendance_file), engine='calamine', header=None, skiprows=1)
             attendance_df.columns = [
                 'ads_id', 'name_in_attendance', 'user_type', 'designation', 'department',
                 'location', 'first_in', 'last_out', 'gross_time', 'out_of_office_time',
                 'out_of_office_count', 'net_office_time', 'attendance_date'
             ]
+            for col in ('name', 'sr no'):
+                roster_df[col] = roster_df[col].astype('category')
+            for col in ('name_in_attendance', 'user_type', 'designation', 'department', 'location'):
+                attendance_df[col] = attendance_df[col].astype('category')
 
             dates = pd.to_datetime(attendance_df['attendance_date'], dayfirst=True, errors='coerce')
             first_valid_date = dates.dropna().iloc[0]
@@ -50,20 +108,42 @@ class FileUploadView(APIView):
             roster_names = roster_df['name'].dropna().unique().tolist()
             attendance_names = attendance_df['name_in_attendance'].dropna().unique().tolist()
 
+            # Normalise both sides once; the processed roster key maps back to its canonical name.
+            roster_keys = {utils.default_process(str(n)): n for n in roster_names}
+            roster_choices = list(roster_keys)
+
+            # Names that normalise to an exact roster key skip the fuzzy matcher entirely.
             name_map = {}
+            leftover_names, leftover_keys = [], []
             for att_name in attendance_names:
-                match = process.extractOne(att_name, roster_names, scorer=fuzz.token_set_ratio)
-                if match and match[1] >= 90:
-                    canonical_name = match[0]
-                    name_map[att_name] = canonical_name
-
-            attendance_df['name'] = attendance_df['name_in_attendance'].map(name_map)
-            matched_names = list(name_map.values())
-            roster_df = roster_df[roster_df['name'].isin(matched_names)]
+                key = utils.default_process(str(att_name))
+                if key in roster_keys:
+                    name_map[att_name] = roster_keys[key]
+                else:
+                    leftover_names.append(att_name)
+                    leftover_keys.append(key)
+
+            if leftover_keys and roster_choices:
+                scores = cdist(
+                    leftover_keys, roster_choices, scorer=fuzz.token_set_ratio,
+                    processor=None, dtype=np.uint8,
+                    score_cutoff=NAME_MATCH_CUTOFF, workers=-1
+                )
+                best = scores.argmax(axis=1)
+                best_score = scores.max(axis=1)
+                for i in np.where(best_score >= NAME_MATCH_CUTOFF)[0]:
+                    name_map[leftover_names[i]] = roster_keys[roster_choices[best[i]]]
+
+            # Recasting to the matched names turns every unmatched roster name into NaN.
+            matched_dtype = pd.CategoricalDtype(categories=list(dict.fromkeys(name_map.values())))
+            attendance_df['name'] = attendance_df['name_in_attendance'].map(name_map).astype(matched_dtype)
+            roster_df['name'] = roster_df['name'].cat.set_categories(matched_dtype.categories)
+            roster_df = roster_df.dropna(subset=['name'])
             attendance_df = attendance_df.dropna(subset=['name'])
 
-            self._process_roster_data(roster_df, processing_year, processing_month)
-            self._process_attendance_data(attendance_df)
+            with transaction.atomic():
+                self._process_roster_data(roster_df, processing_year, processing_month)
+                self._process_attendance_data(attendance_df)
         except Exception as e:
             return Response({'error': f'An error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -73,38 +153,48 @@ class FileUploadView(APIView):
         )
 
     def _process_roster_data(self, df, year, month):
-        for _, row in df.iterrows():
-            name = row.get('name')
-            team = row.get('sr no')
-            for col_name, schedule in row.items():
-                if str(col_name).isdigit():
-                    try:
-                        date = datetime.date(year, month, int(col_name))
-                        Roster.objects.update_or_create(
-                            name=name, date=date,
-                            defaults={'team': team, 'schedule': schedule}
-                        )
-                    except ValueError:
-                        continue
+        day_cols = [c for c in df.columns if str(c).isdigit()]
+        long_df = df.melt(
+            id_vars=['name', 'sr no'], value_vars=day_cols, var_name='day', value_name='schedule'
+        ).dropna(subset=['schedule'])
+        long_df = long_df.rename(columns={'sr no': 'team'})
+        long_df['day'] = pd.to_numeric(long_df['day'], errors='coerce')
+        long_df['date'] = pd.to_datetime(
+            {'year': year, 'month': month, 'day': long_df['day']}, errors='coerce'
+        ).dt.date
+        long_df = long_df.dropna(subset=['date'])
+        long_df = long_df.astype(object).where(long_df.notna(), None)
+
+        Roster.objects.bulk_create(
+            [Roster(name=r.name, team=r.team, date=r.date, schedule=r.schedule) for r in long_df.itertuples(index=False)],
+            **upsert_options(['name', 'date'], ['team', 'schedule'])
+        )
 
     def _process_attendance_data(self, df):
-        df.replace({np.nan: None}, inplace=True)
-        for _, row in df.iterrows():
-            attendance_date = pd.to_datetime(row['attendance_date'], dayfirst=True, errors='coerce').date()
-            if not attendance_date: continue
-
-            defaults = {
-                'employee_id': row['ads_id'], 'user_type': row['user_type'],
-                'designation': row['designation'], 'department': row['department'],
-                'location': row['location'], 'first_in': to_safe_time(row['first_in']),
-                'last_out': to_safe_time(row['last_out']), 'gross_time': to_safe_time(row['gross_time']),
-                'out_of_office_time': to_safe_time(row['out_of_office_time']),
-                'out_of_office_count': row['out_of_office_count'],
-                'net_office_time': to_safe_time(row['net_office_time'])
-            }
-            Attendance.objects.update_or_create(
-                name=row['name'], date=attendance_date, defaults=defaults
+        df = df.assign(
+            attendance_date=pd.to_datetime(
+                df['attendance_date'], dayfirst=True, format='mixed', errors='coerce'
+            ).dt.date
+        )
+        df = df.dropna(subset=['attendance_date'])
+        for col in TIME_COLUMNS:
+            df[col] = vec_to_time(df[col])
+        df = df.astype(object).where(df.notna(), None)
+
+        records = [
+            Attendance(
+                name=t.name, date=t.attendance_date,
+                employee_id=t.ads_id, user_type=t.user_type,
+                designation=t.designation, department=t.department,
+                location=t.location, first_in=t.first_in,
+                last_out=t.last_out, gross_time=t.gross_time,
+                out_of_office_time=t.out_of_office_time,
+                out_of_office_count=t.out_of_office_count,
+                net_office_time=t.net_office_time
             )
+            for t in df.itertuples(index=False)
+        ]
+        Attendance.objects.bulk_create(records, **upsert_options(['name', 'date'], ATTENDANCE_UPDATE_FIELDS))
 
 class SearchView(APIView):
     def get(self, request, *args, **kwargs):
@@ -125,12 +215,10 @@ class SearchView(APIView):
             start_date = pd.to_datetime(start_date_str).date()
             end_date = pd.to_datetime(end_date_str).date() if end_date_str else start_date
         else:
-            last_attendance = Attendance.objects.order_by('-date').first()
-            if not last_attendance: return None, None
-            target_date = last_attendance.date
-            start_date = target_date.replace(day=1)
-            next_month = start_date.replace(day=28) + datetime.timedelta(days=4)
-            end_date = next_month - datetime.timedelta(days=next_month.day)
+            last_date = Attendance.objects.order_by('-date').values_list('date', flat=True).first()
+            if not last_date: return None, None
+            start_date = last_date.replace(day=1)
+            end_date = pd.Period(last_date, 'M').end_time.date()
         return start_date, end_date
 
     def _perform_count(self, request):
@@ -148,76 +236,73 @@ class SearchView(APIView):
         employee_names = []
 
         if employee_id:
-            employee_names = Attendance.objects.filter(
+            employee_names = list(Attendance.objects.filter(
                 employee_id__iexact=employee_id,
                 date__range=[start_date, end_date]
-            ).values_list('name', flat=True).distinct()
-            if not employee_names.exists():
+            ).values_list('name', flat=True).distinct())
+            if not employee_names:
                 return Response({'error': f'No employee found with ID "{employee_id}"'}, status=status.HTTP_404_NOT_FOUND)
 
         elif query:
-            temp_rosters = rosters_query
-            query_words = query.split()
-            for word in query_words:
-                temp_rosters = temp_rosters.filter(name__icontains=word)
-
-            employee_names = temp_rosters.values_list('name', flat=True).distinct()
-            if not employee_names.exists():
+            employee_names = list(rosters_query.filter(name_filter(query)).values_list('name', flat=True).distinct())
+            if not employee_names:
                  return Response({'error': f'No employee found matching "{query}"'}, status=status.HTTP_404_NOT_FOUND)
 
-        results = []
-        WFO_SCHEDULES = {'WFO-M', 'WFO-G', 'WFO-G2', 'WFO-S', 'WFO-N'}
-        WFH_SCHEDULES = {'WFH-M', 'WFH-G', 'WFH-G2', 'WFH-S', 'WFH-N'}
+        schedule_counts = {
+            row['name']: row for row in rosters_query.filter(name__in=employee_names).values('name').annotate(
+                **SCHEDULE_BUCKET_COUNTS
+            )
+        }
+        # One row per name: the attendance row on that name's latest date with a known ID.
+        latest_date = Attendance.objects.filter(
+            name=OuterRef('name'), employee_id__isnull=False
+        ).order_by('-date').values('date')[:1]
+        emp_ids = dict(
+            Attendance.objects.filter(
+                name__in=employee_names, employee_id__isnull=False, date=Subquery(latest_date)
+            ).values_list('name', 'employee_id')
+        )
 
+        results = []
         for name in employee_names:
+            row = schedule_counts.get(name, {})
             counts = {
-                'Total WFO': 0, 'Total WFH': 0, 'Total WO': 0, 'Total PL': 0,
+                'Total WFO': row.get('wfo', 0), 'Total WFH': row.get('wfh', 0),
+                'Total WO': row.get('wo', 0), 'Total PL': row.get('pl', 0),
             }
-            # Filter the main roster query for the specific name
-            employee_rosters = rosters_query.filter(name=name)
-
-            for entry in employee_rosters:
-                schedule = str(entry.schedule).upper() if entry.schedule else ""
-                if schedule in WFO_SCHEDULES:
-                    counts['Total WFO'] += 1
-                elif schedule in WFH_SCHEDULES:
-                    counts['Total WFH'] += 1
-                elif schedule == 'WO':
-                    counts['Total WO'] += 1
-                elif schedule == 'PL':
-                    counts['Total PL'] += 1
-
             counts['Total working days'] = counts['Total WFO'] + counts['Total WFH']
             counts['Total Leaves'] = counts['Total WO'] + counts['Total PL']
 
-            # Fetch the employee ID for the response
-            emp_id = Attendance.objects.filter(name=name).values_list('employee_id', flat=True).first()
-
             results.append({
                 'employee': name,
-                'employee_id': emp_id,
+                'employee_id': emp_ids.get(name),
                 'period_start': start_date.isoformat(),
                 'period_end': end_date.isoformat(),
                 'counts': counts
             })
         return Response(results)
 
+    def _roster_map(self, attendances, excluded):
+        # Fetch rosters for exactly the (name, date) pairs seen in attendance.
+        pairs = {(att.name, att.date) for att in attendances}
+        rosters = Roster.objects.filter(
+            date__in={d for _, d in pairs}, name__in={n for n, _ in pairs}
+        ).exclude(excluded)
+        return {(r.name, r.date): r for r in rosters if (r.name, r.date) in pairs}
+
     def _find_low_hours(self, request):
         start_date, end_date = self._get_date_range(request)
         if not start_date:
             return Response({'error': 'No data found.'}, status=404)
         eight_hours = datetime.time(8, 0)
-        low_hour_attendances = Attendance.objects.filter(
+        low_hour_attendances = list(Attendance.objects.filter(
             date__range=[start_date, end_date],
             net_office_time__lt=eight_hours
-        ).order_by('date', 'name')
+        ).only('name', 'date', 'employee_id', 'net_office_time').order_by('date', 'name'))
 
-        roster_map = {
-            (r.name, r.date): r for r in Roster.objects.filter(
-                date__range=[start_date, end_date],
-                name__in=low_hour_attendances.values_list('name', flat=True)
-            ).exclude(Q(schedule__iexact='PL') | Q(schedule__iexact='WO'))
-        }
+        roster_map = self._roster_map(
+            low_hour_attendances, Q(schedule__iexact='PL') | Q(schedule__iexact='WO')
+        )
 
         results = []
         for att in low_hour_attendances:
@@ -237,15 +322,10 @@ class SearchView(APIView):
         start_date, end_date = self._get_date_range(request)
         if not start_date: return Response({'error': 'No data found.'}, status=404)
         eight_hours = datetime.time(8, 0)
-        low_hour_attendances = Attendance.objects.filter(
+        low_hour_attendances = list(Attendance.objects.filter(
             date__range=[start_date, end_date], net_office_time__lt=eight_hours
-        ).order_by('date', 'name')
-        roster_map = {
-            (r.name, r.date): r for r in Roster.objects.filter(
-                date__range=[start_date, end_date],
-                name__in=low_hour_attendances.values_list('name', flat=True)
-            ).exclude(schedule__iexact='PL')
-        }
+        ).only('name', 'date', 'employee_id', 'net_office_time').order_by('date', 'name'))
+        roster_map = self._roster_map(low_hour_attendances, Q(schedule__iexact='PL'))
         results = []
         for att in low_hour_attendances:
             roster_record = roster_map.get((att.name, att.date))
@@ -271,55 +351,51 @@ class SearchView(APIView):
         rosters = Roster.objects.filter(date__range=[start_date, end_date])
 
         if employee_id:
+            # Kept as a subquery: an unknown ID simply yields no roster rows.
             names_with_id = Attendance.objects.filter(
                 employee_id__iexact=employee_id,
                 date__range=[start_date, end_date]
-            ).values_list('name', flat=True).distinct()
-
-            if not names_with_id.exists():
-                return Response([])
-
-            rosters = rosters.filter(name__in=names_with_id)
+            ).values('name')
+            rosters = rosters.filter(name__in=Subquery(names_with_id))
 
         if teamname:
             rosters = rosters.filter(team__iexact=teamname)
 
         if query:
-            query_words = query.split()
-            for word in query_words:
-                rosters = rosters.filter(name__icontains=word)
+            rosters = rosters.filter(name_filter(query))
 
         if shift:
             rosters = rosters.filter(schedule__iexact=shift)
 
         rosters = rosters.order_by('date', 'name')
 
-        names_to_fetch = rosters.values_list('name', flat=True).distinct()
-        attendance_data = Attendance.objects.filter(
-            name__in=names_to_fetch,
-            date__range=[start_date, end_date]
-        )
-
-        attendance_map = {(att.name, att.date): att for att in attendance_data}
+        attendance_map = {
+            (att['name'], att['date']): att for att in Attendance.objects.filter(
+                name__in=Subquery(rosters.order_by().values('name')),
+                date__range=[start_date, end_date]
+            ).values(
+                'name', 'date', 'employee_id', 'department', 'first_in', 'last_out', 'gross_time',
+                'out_of_office_time', 'out_of_office_count', 'net_office_time'
+            )
+        }
 
         results = []
-        for roster in rosters:
-            attendance_record = attendance_map.get((roster.name, roster.date))
+        for roster in rosters.values('name', 'team', 'date', 'schedule'):
+            attendance_record = attendance_map.get((roster['name'], roster['date']), {})
             results.append({
-                'name': roster.name,
-                'employee_id': attendance_record.employee_id if attendance_record else None,
-                'team': roster.team,
-                'date': roster.date,
-                'schedule': roster.schedule,
+                'name': roster['name'],
+                'employee_id': attendance_record.get('employee_id'),
+                'team': roster['team'],
+                'date': roster['date'],
+                'schedule': roster['schedule'],
                 'attendance': {
-                    'department': attendance_record.department if attendance_record else None,
-                    'first_in': attendance_record.first_in if attendance_record else None,
-                    'last_out': attendance_record.last_out if attendance_record else None,
-                    'gross_time': attendance_record.gross_time if attendance_record else None,
-                    'out_of_office_time': attendance_record.out_of_office_time if attendance_record else None,
-                    'out_of_office_count': attendance_record.out_of_office_count if attendance_record else None,
-                    'net_office_time': attendance_record.net_office_time if attendance_record else None,
+                    'department': attendance_record.get('department'),
+                    'first_in': attendance_record.get('first_in'),
+                    'last_out': attendance_record.get('last_out'),
+                    'gross_time': attendance_record.get('gross_time'),
+                    'out_of_office_time': attendance_record.get('out_of_office_time'),
+                    'out_of_office_count': attendance_record.get('out_of_office_count'),
+                    'net_office_time': attendance_record.get('net_office_time'),
                 }
             })
         return Response(results)
-